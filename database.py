@@ -1,11 +1,25 @@
 __author__ = 'dmiller'
 
+import re
+
 from sqlalchemy import create_engine
+from sqlalchemy import bindparam, func, inspect, select, Index, MetaData, Table
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey
 
 # sql tests
-engine = create_engine('sqlite:///data.db')
+url = 'sqlite:///data.db'
+
+# bump this whenever the tables change so they are created on next use
+SCHEMA_VERSION = 10
+
+# created on first use by getengine()
+engine = None
+
+# store articles in per month tables (see insertarticles); once set this is
+# remembered in the database (see checklayout)
+partitioned = False
 
 Base = declarative_base()
 
@@ -15,6 +29,8 @@ class Groups(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(700), unique=True, index=True)
+    low = Column(Integer)
+    high = Column(Integer)
 
 class Articles(Base):
     __tablename__ = 'articles'
@@ -27,6 +43,625 @@ class Articles(Base):
     h_references = Column(String(1024))
     h_bytes = Column(Integer)
     h_lines = Column(Integer)
+    group_id = Column(Integer, index=True)
+    h_file = Column(String(700), index=True)
+    part = Column(Integer)
+    parts = Column(Integer)
+
+    # the parts of a file in order (oldest post of each part first), for
+    # writing NZBs
+    __table_args__ = (Index('ix_articles_h_file_part', 'h_file', 'part', 'h_date'),)
+
+class GroupStats(Base):
+    __tablename__ = 'group_stats'
+
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey('groups.id'), unique=True, index=True)
+    articles = Column(Integer, default=0)
+    bytes = Column(BigInteger, default=0)
+    date_min = Column(DateTime)
+    date_max = Column(DateTime)
+    number_low = Column(Integer)
+    number_high = Column(Integer)
+
+# maintain statistics
+def updatestats(session, group_id, articles, numbers):
+    """Fold a batch of newly added articles into a group's statistics.
+
+    Call this in the same transaction as the insert of the articles so the
+    statistics never disagree with the table. Each article is a dict of
+    Articles columns; numbers holds their article numbers in the group.
+    """
+    if not articles:
+        return
+
+    stats = session.query(GroupStats).filter_by(group_id=group_id).first()
+    if stats is None:
+        stats = GroupStats(group_id=group_id, articles=0, bytes=0)
+        session.add(stats)
+
+    dates = [a['h_date'] for a in articles if a['h_date'] is not None]
+
+    stats.articles += len(articles)
+    stats.bytes += sum(a['h_bytes'] for a in articles)
+
+    if dates:
+        stats.date_min = min(dates + [stats.date_min]) if stats.date_min else min(dates)
+        stats.date_max = max(dates + [stats.date_max]) if stats.date_max else max(dates)
+
+    stats.number_low = min(numbers + [stats.number_low]) if stats.number_low is not None else min(numbers)
+    stats.number_high = max(numbers + [stats.number_high]) if stats.number_high is not None else max(numbers)
+
+class Threads(Base):
+    __tablename__ = 'threads'
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(String(700), unique=True, index=True)
+    parent_id = Column(String(700))
+    root_id = Column(String(700), index=True)
+
+# queries over many values
+def executein(session, statement, column, values):
+    """Execute a statement for a column matching any of a list of values.
+
+    The values are sent in batches of 500 so long lists stay within the
+    database's limit on bound parameters. Returns the rows of every batch
+    for a select, otherwise an empty list.
+    """
+    values = list(set(values))
+    rows = []
+
+    for i in range(0, len(values), 500):
+        result = session.execute(statement.where(column.in_(values[i:i+500])))
+        if result.returns_rows:
+            rows.extend(result.fetchall())
+
+    return rows
+
+def knownarticles(session, message_ids):
+    """Get the set of message-ids from a list that are already indexed.
+
+    """
+    table = articlestable()
+    query = select([table.c.h_message_id])
+
+    return set(message_id for (message_id,) in executein(session, query, table.c.h_message_id, message_ids))
+
+# maintain the thread index
+def updatethreads(session, articles):
+    """Add a batch of newly added articles to the thread index.
+
+    The parent of an article is the last entry of its References header
+    and the root is the first (RFC 5537 keeps the first entry when
+    trimming). Articles can arrive before the articles they reference, so
+    when a new article turns out to belong to a larger thread every article
+    that had been rooted at it is moved to the new root. Articles already in
+    the index are left as they are.
+    """
+    if not articles:
+        return
+
+    table = Threads.__table__
+
+    # work out parent and root from the references
+    threads = {}
+    for article in articles:
+        references = (article['h_references'] or '').split()
+        if references:
+            threads[article['h_message_id']] = [references[-1], references[0]]
+        else:
+            threads[article['h_message_id']] = [None, article['h_message_id']]
+
+    # skip articles already in the index (re-ingested after an expiry)
+    for (message_id,) in executein(session, select([table.c.message_id]), table.c.message_id, threads):
+        del threads[message_id]
+
+    if not threads:
+        return
+
+    # follow roots we already know about to the top of their thread
+    ids = [root for parent, root in threads.values() if root not in threads]
+    roots = dict(executein(session, select([table.c.message_id, table.c.root_id]), table.c.message_id, ids))
+
+    for message_id, thread in threads.items():
+        root = thread[1]
+        if root in threads and threads[root][1] != root:
+            root = threads[root][1]
+        thread[1] = roots.get(root, root)
+
+    # find articles that arrived before the new articles they belong under
+    moved = [m for m, thread in threads.items() if thread[1] != m]
+    for (old_root,) in executein(session, select([table.c.root_id]).distinct(), table.c.root_id, moved):
+        session.execute(table.update().where(table.c.root_id == old_root).values(root_id=threads[old_root][1]))
+
+    session.execute(table.insert(), [dict(message_id=m, parent_id=t[0], root_id=t[1]) for m, t in threads.items()])
+
+def rethread(session, articles):
+    """Re-index articles whose References header has changed.
+
+    Their entries are rebuilt as if the articles had just arrived and the
+    new root is then passed down to every reply below them.
+    """
+    if not articles:
+        return
+
+    table = Threads.__table__
+    ids = [article['h_message_id'] for article in articles]
+
+    executein(session, table.delete(), table.c.message_id, ids)
+
+    updatethreads(session, articles)
+
+    roots = dict(executein(session, select([table.c.message_id, table.c.root_id]), table.c.message_id, ids))
+
+    # walk down the replies, stopping where the root is already right
+    while roots:
+        moved = {}
+        query = select([table.c.message_id, table.c.parent_id, table.c.root_id])
+        for message_id, parent_id, root_id in executein(session, query, table.c.parent_id, roots):
+            if root_id != roots[parent_id]:
+                moved[message_id] = roots[parent_id]
+
+        if moved:
+            statement = table.update().where(table.c.message_id == bindparam('id')).values(root_id=bindparam('root'))
+            session.execute(statement, [dict(id=m, root=r) for m, r in moved.items()])
+
+        roots = moved
+
+def getthread(session, message_id):
+    """Get every indexed article in the thread of a message-id.
+
+    Returns rows of the articles table (or view when partitioned) along
+    with parent_id, oldest first.
+    """
+    table = Threads.__table__
+    articles = articlestable()
+
+    root = session.execute(select([table.c.root_id]).where(table.c.message_id == message_id)).scalar()
+    if root is None:
+        root = message_id
+
+    query = select([articles, table.c.parent_id]).select_from(
+        table.join(articles, articles.c.h_message_id == table.c.message_id)
+    ).where(table.c.root_id == root).order_by(articles.c.h_date)
+
+    return session.execute(query).fetchall()
+
+class Coverage(Base):
+    __tablename__ = 'coverage'
+
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey('groups.id'), index=True)
+    low = Column(Integer)
+    high = Column(Integer)
+
+# maintain article coverage
+def numberruns(numbers):
+    """Collapse article numbers into sorted (low, high) runs.
+
+    """
+    runs = []
+
+    for number in sorted(set(numbers)):
+        if runs and number == runs[-1][1] + 1:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+
+    return [tuple(run) for run in runs]
+
+class EmptyRanges(Base):
+    __tablename__ = 'empty_ranges'
+
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey('groups.id'), index=True)
+    low = Column(Integer)
+    high = Column(Integer)
+
+def missingruns(low, high, numbers):
+    """List the (low, high) runs of a range not in a list of article numbers.
+
+    """
+    runs = []
+    start = low
+
+    for run_low, run_high in numberruns(n for n in numbers if low <= n <= high):
+        if run_low > start:
+            runs.append((start, run_low - 1))
+        start = run_high + 1
+
+    if start <= high:
+        runs.append((start, high))
+
+    return runs
+
+def addruns(session, table, group_id, runs):
+    """Store (low, high) runs for a group in a coverage style table.
+
+    Runs are stored run-length encoded; new runs are merged with any stored
+    runs they overlap or touch so the table stays compact.
+    """
+    if not runs:
+        return
+
+    low = min(run[0] for run in runs)
+    high = max(run[1] for run in runs)
+
+    # stored runs that may need merging with ours
+    query = select([table.c.id, table.c.low, table.c.high]).where(
+        (table.c.group_id == group_id) & (table.c.high >= low - 1) & (table.c.low <= high + 1))
+    existing = session.execute(query).fetchall()
+
+    merged = []
+    for run_low, run_high in sorted(list(runs) + [(r.low, r.high) for r in existing]):
+        if merged and run_low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], run_high)
+        else:
+            merged.append([run_low, run_high])
+
+    if existing:
+        session.execute(table.delete().where(table.c.id.in_([r.id for r in existing])))
+
+    session.execute(table.insert(), [dict(group_id=group_id, low=run_low, high=run_high) for run_low, run_high in merged])
+
+def addcoverage(session, group_id, runs):
+    """Record (low, high) runs of article numbers as received for a group.
+
+    """
+    addruns(session, Coverage.__table__, group_id, runs)
+
+def addempty(session, group_id, runs):
+    """Record (low, high) runs of article numbers the server has no articles for.
+
+    Only record ranges from a complete response; they are kept apart from
+    the coverage of articles actually received.
+    """
+    addruns(session, EmptyRanges.__table__, group_id, runs)
+
+def getgaps(session, group_id, low, high):
+    """List the (low, high) ranges of article numbers we have not received.
+
+    Ranges known to be empty on the server are not gaps.
+    """
+    runs = []
+    for table in (Coverage.__table__, EmptyRanges.__table__):
+        query = select([table.c.low, table.c.high]).where(
+            (table.c.group_id == group_id) & (table.c.high >= low) & (table.c.low <= high))
+        runs.extend(session.execute(query).fetchall())
+
+    gaps = []
+    start = low
+    for run_low, run_high in sorted(runs):
+        if run_low > start:
+            gaps.append((start, run_low - 1))
+        start = max(start, run_high + 1)
+
+    if start <= high:
+        gaps.append((start, high))
+
+    return gaps
+
+def lastcovered(session, group_id):
+    """Get the highest article number received for a group (None if none).
+
+    """
+    table = Coverage.__table__
+
+    return session.execute(select([func.max(table.c.high)]).where(table.c.group_id == group_id)).scalar()
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+
+class Settings(Base):
+    __tablename__ = 'settings'
+
+    name = Column(String(100), primary_key=True)
+    value = Column(String(1024))
+
+# partitioned article storage
+#
+# When partitioned is set, articles are written to one table per month of
+# h_date (articles_YYYYMM) instead of the articles table. Inserts only touch
+# the current month's table and retention is handled by dropping whole
+# tables. The articles_all view unions the articles table and every
+# partition for querying.
+partitions = MetaData()
+partition_pattern = re.compile(r"^articles_(\d{6})$")
+
+# partitions we know exist
+created_partitions = set()
+
+def partitionname(date):
+    """Get the name of the partition table for a date.
+
+    """
+    return 'articles_' + date.strftime('%Y%m')
+
+def partitiontable(name):
+    """Get the Table object for a partition, defining it if needed.
+
+    """
+    if name in partitions.tables:
+        return partitions.tables[name]
+
+    table = Table(name, partitions, *[c.copy() for c in Articles.__table__.columns])
+    Index('ix_%s_h_file_part' % name, table.c.h_file, table.c.part, table.c.h_date)
+
+    return table
+
+def listpartitions(connection):
+    """List the partition tables that exist in the database in order.
+
+    """
+    names = [n for n in inspect(connection).get_table_names() if partition_pattern.match(n)]
+    names.sort()
+    return names
+
+def createview(connection):
+    """(Re)create the articles_all view over the articles table and every partition.
+
+    """
+    columns = ", ".join(c.name for c in Articles.__table__.columns)
+    tables = [Articles.__tablename__] + listpartitions(connection)
+
+    connection.execute("DROP VIEW IF EXISTS articles_all")
+    connection.execute("CREATE VIEW articles_all AS " + " UNION ALL ".join("SELECT %s FROM %s" % (columns, t) for t in tables))
+
+def articletables(connection):
+    """List the tables holding articles.
+
+    This is the articles table and, when partitioned, every partition. Use
+    it for updates, which can not go through the view.
+    """
+    tables = [Articles.__table__]
+
+    if partitioned:
+        tables.extend(partitiontable(name) for name in listpartitions(connection))
+
+    return tables
+
+def articlestable():
+    """Get the table to query for articles.
+
+    This is the articles_all view when partitioned, otherwise the articles
+    table itself.
+    """
+    if not partitioned:
+        return Articles.__table__
+
+    if 'articles_all' in partitions.tables:
+        return partitions.tables['articles_all']
+
+    return Table('articles_all', partitions, *[Column(c.name, c.type) for c in Articles.__table__.columns])
+
+def insertarticles(session, articles):
+    """Insert a batch of articles (dicts of Articles columns).
+
+    When partitioned the articles are split by month of h_date and each
+    group is inserted into its partition, creating the partition (and
+    updating the view) the first time it is used.
+    """
+    if not articles:
+        return
+
+    if not partitioned:
+        session.execute(Articles.__table__.insert(), articles)
+        return
+
+    batches = {}
+    for article in articles:
+        batches.setdefault(partitionname(article['h_date']), []).append(article)
+
+    connection = session.connection()
+    existing = None
+
+    for name, batch in batches.items():
+        table = partitiontable(name)
+
+        if name not in created_partitions:
+            if existing is None:
+                existing = listpartitions(connection)
+            if name not in existing:
+                table.create(connection)
+                createview(connection)
+                existing.append(name)
+            created_partitions.add(name)
+
+        session.execute(table.insert(), batch)
+
+def expirepartitions(session, before):
+    """Drop every partition holding only articles older than a date.
+
+    Dropping a table is near instant no matter how many rows it has. The
+    thread index entries of the dropped articles are removed first and the
+    statistics of every group that lost articles are recomputed from the
+    articles that are left. Returns the names of the partitions dropped.
+    """
+    connection = session.connection()
+    cutoff = partitionname(before)
+    threads = Threads.__table__
+
+    dropped = []
+    groups = set()
+    for name in listpartitions(connection):
+        if name < cutoff:
+            table = partitiontable(name)
+
+            # note the groups losing articles and forget their threads
+            groups.update(group_id for (group_id,) in connection.execute(select([table.c.group_id]).distinct()))
+            connection.execute(threads.delete().where(threads.c.message_id.in_(select([table.c.h_message_id]))))
+
+            table.drop(connection)
+            created_partitions.discard(name)
+            dropped.append(name)
+
+    if dropped:
+        createview(connection)
+        recomputestats(session, [g for g in groups if g is not None])
+
+    return dropped
+
+def recomputestats(session, group_ids):
+    """Recompute the statistics of groups from the articles indexed.
+
+    Article numbers are not stored with the articles, so number_low and
+    number_high are left as they are.
+    """
+    articles = articlestable()
+
+    for group_id in group_ids:
+        query = select([func.count(), func.sum(articles.c.h_bytes), func.min(articles.c.h_date), func.max(articles.c.h_date)]).where(
+            articles.c.group_id == group_id)
+        count, total, date_min, date_max = session.execute(query).fetchone()
+
+        stats = session.query(GroupStats).filter_by(group_id=group_id).first()
+        if stats is None:
+            continue
+
+        stats.articles = count
+        stats.bytes = total or 0
+        stats.date_min = date_min
+        stats.date_max = date_max
+
+def fillfiles(engine, table):
+    """Fill in h_file, part and parts from h_subject where they are missing.
+
+    Articles indexed before these columns existed have them NULL and would
+    be left out of NZBs. The group of those articles was never stored, so
+    group_id stays NULL and their NZB entries have no group.
+    """
+    import nntp.overview
+
+    statement = table.update().where(table.c.id == bindparam('row_id')).values(
+        h_file=bindparam('file_name'), part=bindparam('file_part'), parts=bindparam('file_parts'))
+
+    last = 0
+    while True:
+        query = select([table.c.id, table.c.h_subject]).where(
+            (table.c.h_file == None) & (table.c.id > last)).order_by(table.c.id).limit(500)
+        rows = engine.execute(query).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for row_id, subject in rows:
+            name, part, parts = nntp.overview.filepart(subject or '')
+            updates.append(dict(row_id=row_id, file_name=name[:700], file_part=part, file_parts=parts))
+
+        engine.execute(statement, updates)
+        last = rows[-1].id
+
+def fillthreads(engine, table):
+    """Add articles missing from the thread index to it.
+
+    Articles indexed before the thread index existed have no entry and
+    would be left out of getthread.
+    """
+    threads = Threads.__table__
+    session = sessionmaker(bind=engine)()
+
+    try:
+        while True:
+            query = select([table.c.h_message_id, table.c.h_references]).select_from(
+                table.outerjoin(threads, threads.c.message_id == table.c.h_message_id)
+            ).where(threads.c.id == None).limit(500)
+            rows = session.execute(query).fetchall()
+            if not rows:
+                break
+
+            updatethreads(session, [dict(h_message_id=r.h_message_id, h_references=r.h_references) for r in rows])
+            session.commit()
+    finally:
+        session.close()
+
+# engine and schema
+def checkschema(engine):
+    """Create any missing tables if the schema version has changed.
+
+    Reading the version marker is a single query, so the (much slower)
+    create_all with its per table checks only runs when the schema version
+    changes or the database is new. Columns added to existing tables are
+    added with ALTER TABLE (without constraints) along with any missing
+    indexes; anything more involved still needs a migration.
+    """
+    try:
+        version = engine.execute(SchemaVersion.__table__.select()).scalar()
+    except Exception:
+        version = None
+
+    if version == SCHEMA_VERSION:
+        return
+
+    # create all tables
+    Base.metadata.create_all(engine)
+
+    # add any new columns to tables (and partitions) that already existed
+    inspector = inspect(engine)
+    tables = Base.metadata.sorted_tables + [partitiontable(name) for name in listpartitions(engine)]
+    for table in tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table.name, column.name, column.type.compile(engine.dialect)))
+                if column.index:
+                    Index("ix_%s_%s" % (table.name, column.name), column).create(engine)
+
+    # add any new indexes over more than one column
+    inspector = inspect(engine)
+    for table in tables:
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if len(index.columns) > 1 and index.name not in indexes:
+                index.create(engine)
+
+    # derive the file columns and thread index entries of articles indexed
+    # before they existed
+    for table in [Articles.__table__] + [partitiontable(name) for name in listpartitions(engine)]:
+        fillfiles(engine, table)
+        fillthreads(engine, table)
+
+    createview(engine)
+
+    engine.execute(SchemaVersion.__table__.delete())
+    engine.execute(SchemaVersion.__table__.insert(), version=SCHEMA_VERSION)
+
+def checklayout(engine):
+    """Use (and remember) the partitioned layout of the database.
+
+    Once articles have been stored in partitions every later run has to
+    read them the same way, whether or not it was asked to. Databases
+    partitioned before the layout was stored are recognised by their
+    partition tables.
+    """
+    global partitioned
+
+    table = Settings.__table__
+    stored = engine.execute(select([table.c.value]).where(table.c.name == 'partitioned')).scalar()
+
+    if stored == '1':
+        partitioned = True
+    elif partitioned or listpartitions(engine):
+        partitioned = True
+        engine.execute(table.insert(), name='partitioned', value='1')
+
+def getengine():
+    """Get the database engine, creating it (and the schema) on first use.
+
+    """
+    global engine
+
+    if engine is None:
+        engine = create_engine(url)
+        checkschema(engine)
+        checklayout(engine)
+
+    return engine
+
+def getsession():
+    """Get a new session bound to our engine.
 
-# create all tables
-Base.metadata.create_all(engine)
\ No newline at end of file
+    """
+    Session = sessionmaker(bind=getengine())
+    return Session()
\ No newline at end of file
@@ -5,16 +5,15 @@ be fully implemented within a single python file.
 """
 
 import argparse
-from dateutil import parser
 import sys
-import zlib
 
+import nntp.cache
+import nntp.fetcher
 import nntp.nntp
-import yEnc.Decoder
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import literal
-import database
+# the database, dateutil and decoding modules are slow to import so they are
+# imported where they are first needed; this keeps --help and worker start up
+# fast
 
 # Begin configuration area
 
@@ -23,10 +22,297 @@ port = 563
 username = 'username'
 password = 'password'
 use_ssl = True
+newsgroups = 'alt.test'
+
+# connect/read timeout in seconds (None to wait forever)
+timeout = None
+
+# socket receive buffer size in bytes (None for the system default) and
+# whether to disable Nagle's algorithm
+rcvbuf = None
+nodelay = True
+
+# store articles in per month tables
+partitioned = False
+
+# articles to request per XZVER command
+range_size = 250000
+
+# connections to open to the server while indexing
+connections = 1
+
+# additional servers to index from, as dicts of nntp.fetcher.Server
+# arguments; ranges are shared between all servers by weight and measured
+# throughput and retried on another server if they fail, e.g.
+# {'host': 'news.other.com', 'port': 563, 'use_ssl': True,
+#  'username': 'username', 'password': 'password', 'connections': 4,
+#  'weight': 2}
+servers = []
+
+# processes to decode overview data in (None to decode in this process)
+workers = None
+
+# directory to cache compressed overview data in (None to disable)
+cache_dir = None
+cache_size = None
 
 # End configuration area
 
 
+def decode(data):
+    """Decode a block of compressed overview data into overview lines.
+
+    The data is the raw yEnc encoded response of an XZVER command, either
+    straight from the server or from the overview cache. This is a module
+    level function so it can be run in a process pool.
+    """
+    import zlib
+    import yEnc.Decoder
+
+    d = yEnc.Decoder.Decoder(data)
+    return zlib.decompress(d.data, -15).splitlines()
+
+
+def trydecode(data):
+    """Decode a block of compressed overview data, returning None if it is damaged.
+
+    """
+    import zlib
+    from yEnc.yEncException import yEncException
+
+    try:
+        return decode(data)
+    except (yEncException, zlib.error, ValueError):
+        return None
+
+
+def fetchranges(conn, low, high, step):
+    """Fetch the compressed overview of the selected group range by range.
+
+    Yields (low, high, data) for each range that returned data.
+    """
+    for start in range(low, high + 1, step):
+        end = min(start + step - 1, high)
+
+        print("Sending Xzver command for %d-%d..." % (start, end))
+        data = conn.zver(start, end)
+        if data is False:
+            print("Xzver command failed...")
+            continue
+
+        if data:
+            yield start, end, data
+
+
+def decodeblocks(blocks, workers=None):
+    """Decode blocks of compressed overview data in order.
+
+    Takes (low, high, data) tuples and yields (low, high, lines), where
+    lines is None for a block that could not be decoded. If workers is set the blocks are decoded in a process pool while the next blocks
+    are fetched; results are still yielded in article number order and only
+    a bounded number of blocks are in flight.
+    """
+    if not workers:
+        for low, high, data in blocks:
+            yield low, high, trydecode(data)
+        return
+
+    import collections
+    import multiprocessing
+
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+
+    try:
+        for low, high, data in blocks:
+            pending.append((low, high, pool.apply_async(trydecode, (data,))))
+
+            if len(pending) >= workers * 2:
+                low, high, result = pending.popleft()
+                yield low, high, result.get()
+
+        while pending:
+            low, high, result = pending.popleft()
+            yield low, high, result.get()
+    finally:
+        pool.terminate()
+
+
+def ingest(session, group_id, lines, positions=None):
+    """Add a block of overview lines to the database.
+
+    Rows are kept as lazy Overview objects and duplicates are found with one
+    query per batch of message-ids, so rows we already have are skipped
+    without converting any of their fields. Returns the article numbers of
+    every row received.
+    """
+    import database
+    import nntp.overview
+
+    rows = [nntp.overview.Overview(line, positions) for line in lines]
+
+    # find the message-ids we already have
+    seen = database.knownarticles(session, [row.message_id for row in rows])
+
+    articles = []
+    numbers = []
+    for row in rows:
+        message_id = row.message_id
+        if message_id in seen:
+            continue
+        seen.add(message_id)
+
+        name, part, parts = row.part
+
+        articles.append(dict(
+            group_id=group_id,
+            h_file=name[:700],
+            part=part,
+            parts=parts,
+            h_subject=row.subject,
+            h_from=row.author,
+            h_date=row.date,
+            h_message_id=message_id,
+            h_references=row.references,
+            h_bytes=row.bytes,
+            h_lines=row.lines
+        ))
+        numbers.append(row.number)
+
+    # insert all new articles at once
+    database.insertarticles(session, articles)
+
+    # keep the group statistics, thread index and coverage map in the same
+    # transaction; coverage includes duplicates since they were received
+    database.updatestats(session, group_id, articles, numbers)
+    database.updatethreads(session, articles)
+    received = [row.number for row in rows]
+    database.addcoverage(session, group_id, database.numberruns(received))
+
+    session.commit()
+
+    return received
+
+
+def refresh(conn, session, field, low, high, step):
+    """Refresh a single header of indexed articles in the selected group.
+
+    Only the Message-ID and the header being refreshed are transferred (via
+    HDR/XHDR) rather than the whole overview. Results are streamed and
+    written out range by range. Refreshing the subject also updates the
+    file, part and parts derived from it.
+    """
+    from sqlalchemy import bindparam
+    import database
+    import nntp.overview
+
+    column = {'subject': 'h_subject', 'from': 'h_from', 'references': 'h_references'}[field.lower()]
+
+    for start in range(low, high + 1, step):
+        end = min(start + step - 1, high)
+
+        # map article numbers to message-ids for this range
+        ids = {}
+        if conn.hdr("Message-ID", start, end, ids.__setitem__) is False:
+            print("Header command failed for %d-%d..." % (start, end))
+            continue
+
+        updates = []
+
+        def collect(number, value):
+            if number in ids:
+                updates.append({'message_id': ids[number], 'value': value})
+
+        if conn.hdr(field, start, end, collect) is False:
+            print("Header command failed for %d-%d..." % (start, end))
+            continue
+
+        values = {column: bindparam('value')}
+
+        # the file columns are derived from the subject
+        if column == 'h_subject':
+            values.update(h_file=bindparam('file_name'), part=bindparam('file_part'), parts=bindparam('file_parts'))
+            for u in updates:
+                name, part, parts = nntp.overview.filepart(u['value'])
+                u.update(file_name=name[:700], file_part=part, file_parts=parts)
+
+        if updates:
+            for table in database.articletables(session.connection()):
+                statement = table.update().where(table.c.h_message_id == bindparam('message_id')).values(values)
+                session.execute(statement, updates)
+
+            # move the indexed articles to their (possibly new) threads
+            if column == 'h_references':
+                known = database.knownarticles(session, [u['message_id'] for u in updates])
+                database.rethread(session, [dict(h_message_id=u['message_id'], h_references=u['value']) for u in updates if u['message_id'] in known])
+        session.commit()
+
+        print("Refreshed %d-%d..." % (start, end))
+
+
+def backfill(conn, session, group_id, low, high, step, positions=None):
+    """Fetch only the article ranges of the selected group we have not received.
+
+    Gaps come from the coverage map. Only the articles received are marked
+    as covered; the numbers a complete response left out (or a whole range
+    the server says has no articles) are remembered as empty so they are
+    not asked for again. The overview cache is bypassed so a truncated
+    cached block is not replayed.
+    """
+    import database
+
+    cache, conn.cache = conn.cache, None
+
+    try:
+        for gap_low, gap_high in database.getgaps(session, group_id, low, high):
+            for start in range(gap_low, gap_high + 1, step):
+                end = min(start + step - 1, gap_high)
+
+                print("Backfilling %d-%d..." % (start, end))
+                data = conn.zver(start, end)
+
+                # 423 means there are no articles in the range
+                if data is False and conn.code == '423':
+                    lines = []
+                elif data is False:
+                    print("Xzver command failed...")
+                    continue
+                elif not data:
+                    lines = []
+                else:
+                    lines = trydecode(data)
+                    if lines is None:
+                        print("Failed to decode %d-%d..." % (start, end))
+                        continue
+
+                # ingest records the coverage of what we received
+                received = []
+                if lines:
+                    received = ingest(session, group_id, lines, positions)
+
+                # the response was complete, so anything it left out does not
+                # exist on the server
+                database.addempty(session, group_id, database.missingruns(start, end, received))
+                session.commit()
+    finally:
+        conn.cache = cache
+
+
+def getgroup(session, name):
+    """Get the id of a group, adding it to the database if needed.
+
+    """
+    import database
+
+    try:
+        return session.query(database.Groups).filter_by(name=name).one().id
+    except:
+        group = database.Groups(name=name)
+        session.add(group)
+        session.flush()
+        return group.id
+
+
 if __name__ == '__main__':
     
     # argument parsing comes first
@@ -42,6 +328,23 @@ if __name__ == '__main__':
     argparser.add_argument("--ssl", help="use ssl for connecting to server", action="store_true")
     argparser.add_argument("--user", help="username for posting server")
     argparser.add_argument("--pass", help="password for posting server")
+    argparser.add_argument("--timeout", help="connect and read timeout in seconds", type=float)
+    argparser.add_argument("--range-size", help="articles to request per overview command", type=int)
+    argparser.add_argument("--connections", help="connections to open to the server while indexing", type=int)
+    argparser.add_argument("--workers", help="processes to decode overview data in", type=int)
+    argparser.add_argument("--cache", help="directory to cache compressed overview data in")
+    argparser.add_argument("--cache-size", help="maximum size of the overview cache in megabytes", type=int)
+    argparser.add_argument("--partitioned", help="store articles in per month tables (remembered by the database)", action="store_true")
+    argparser.add_argument("--expire", help="drop partitioned articles older than this many days and exit", type=int)
+    argparser.add_argument("--refresh", help="refresh one header (subject, from or references) of indexed articles", choices=['subject', 'from', 'references'])
+    argparser.add_argument("--gaps", help="show article ranges missing from the index without connecting", action="store_true")
+    argparser.add_argument("--backfill", help="fetch only the article ranges missing from the index", action="store_true")
+    argparser.add_argument("--nzb", help="write an NZB for files named this (or starting with it if it ends in %%; other SQL LIKE patterns are slow) without connecting")
+    argparser.add_argument("--output", help="file to write the NZB to (default standard output)")
+    argparser.add_argument("--nzb-cache", help="directory to cache generated NZB files in")
+    argparser.add_argument("--thread", help="show the thread of a message-id without connecting")
+    argparser.add_argument("--stats", help="show statistics for the newsgroups without connecting", action="store_true")
+    argparser.add_argument("--replay", help="rebuild the database from the overview cache without connecting", action="store_true")
     args = argparser.parse_args()
     
     # override any passed values
@@ -57,9 +360,109 @@ if __name__ == '__main__':
         username = args.user
     if getattr(args, 'pass'):
         password = getattr(args, 'pass')
-    
+    if args.timeout:
+        timeout = args.timeout
+    if args.range_size:
+        range_size = args.range_size
+    if args.connections:
+        connections = args.connections
+    if args.workers:
+        workers = args.workers
+    if args.cache:
+        cache_dir = args.cache
+    if args.cache_size:
+        cache_size = args.cache_size * 1024 * 1024
+
+    # set up our overview cache
+    cache = None
+    if cache_dir:
+        cache = nntp.cache.OverviewCache(cache_dir, cache_size)
+
+    if args.partitioned:
+        partitioned = True
+
+    import database
+    database.partitioned = partitioned
+    session = database.getsession()
+
+    # drop expired partitions
+    if args.expire is not None:
+        import datetime
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=args.expire)
+        dropped = database.expirepartitions(session, before)
+        session.commit()
+        print("Expired %d partitions..." % len(dropped))
+        sys.exit()
+
+    # write an nzb from the index
+    if args.nzb:
+        import nzb
+
+        out = sys.stdout
+        if args.output:
+            out = open(args.output, 'wb')
+
+        if args.nzb_cache:
+            nzb.NzbCache(args.nzb_cache).write(session, out, args.nzb)
+        else:
+            nzb.writenzb(session, out, args.nzb)
+
+        out.close()
+        sys.exit()
+
+    # show a thread from our thread index
+    if args.thread:
+        for article in database.getthread(session, args.thread):
+            print("%s %s %s" % (article.h_date, article.h_message_id, article.h_subject))
+        sys.exit()
+
+    # show the article ranges we are missing
+    if args.gaps:
+        for name in newsgroups.split(","):
+            group = session.query(database.Groups).filter_by(name=name).first()
+            if group is None or group.low is None:
+                print("%s: article range unknown" % name)
+                continue
+            gaps = database.getgaps(session, group.id, group.low, group.high)
+            print("%s: %d gaps, %d articles missing" % (name, len(gaps), sum(high - low + 1 for low, high in gaps)))
+            for low, high in gaps:
+                print("    %d-%d" % (low, high))
+        sys.exit()
+
+    # show our precomputed group statistics
+    if args.stats:
+        for name in newsgroups.split(","):
+            stats = session.query(database.GroupStats).join(database.Groups, database.Groups.id == database.GroupStats.group_id).filter(database.Groups.name == name).first()
+            if stats is None:
+                print("%s: no articles indexed" % name)
+            else:
+                print("%s: %d articles, %d bytes, %s to %s, articles %d-%d" % (name, stats.articles, stats.bytes, stats.date_min, stats.date_max, stats.number_low, stats.number_high))
+        sys.exit()
+
+    # replay from our cache without touching the network
+    if args.replay:
+        if cache is None:
+            print("Replay requires an overview cache...")
+            sys.exit()
+
+        for name in newsgroups.split(","):
+            print("Replaying %s from cache..." % name)
+            group_id = getgroup(session, name)
+            blocks = ((low, high, cache.get(name, low, high)) for low, high in cache.ranges(name))
+            for low, high, lines in decodeblocks(((low, high, data) for low, high, data in blocks if data is not None), workers):
+                # drop damaged blocks from the cache
+                if lines is None:
+                    print("Failed to decode %d-%d, removed from cache..." % (low, high))
+                    cache.remove(name, low, high)
+                    continue
+
+                ingest(session, group_id, lines)
+
+        print("Replay complete...")
+        sys.exit()
+
     # get a nntp object
-    conn = nntp.nntp.MyNntp(server, port, use_ssl)
+    conn = nntp.nntp.MyNntp(server, port, use_ssl, cache, connect_timeout=timeout, read_timeout=timeout, rcvbuf=rcvbuf, nodelay=nodelay)
     
     # connect to server
     print("Connecting to server...")
@@ -78,9 +481,6 @@ if __name__ == '__main__':
         print("Exiting...")
         sys.exit()
 
-    Session = sessionmaker(bind=database.engine)
-    session = Session()
-
     # list newsgroups
     print ("Listing newsgroups...")
     results = conn.listactive()
@@ -99,53 +499,100 @@ if __name__ == '__main__':
     session.commit()
 
     print ("Listing complete... %d results..." % len(results))
-    
-    # group command
-    print("Selecting active group...")
-    if conn.group("alt.test"):
-        print("Group command successful...")
-    else:
-        print("Group command failed...")
-
-    # xover command
-    # print("Sending XOver command...")
-    # if conn.over():
-    #     print("XOver command successful...")
-    # else:
-    #     print("XOver command failed...")
-
-    # xzver command
-    print("Sending Xzver command...")
-    data = conn.zver(conn.group_low, conn.group_low+249999)
-    if data:
-        print("Xzver command successful...")
-        d = yEnc.Decoder.Decoder(data)
-        data = zlib.decompress(d.data, -15)
-
-        for line in data.splitlines():
-
-            f = line.split("\t")
-            try:
-                existing = session.query(database.Articles).filter_by(h_message_id=f[4]).one()
-            except:
-                article = database.Articles(
-                    h_subject=f[1],
-                    h_from=f[2],
-                    h_date=parser.parse(f[3]),
-                    h_message_id=f[4],
-                    h_references=f[5],
-                    h_bytes=int(f[6]),
-                    h_lines=int(f[7])
-                )
-                session.add(article)
 
+    # find out where the server puts each overview field
+    import nntp.overview
+    positions = None
+    fmt = conn.overviewfmt()
+    if fmt:
+        positions = nntp.overview.fieldpositions(fmt)
+
+    for name in newsgroups.split(","):
+        # reopen our connection if it was closed for the fetcher
+        if conn.s is None:
+            print("Reconnecting to server...")
+            if not (conn.connect() and conn.login(username, password)):
+                print("Unable to reconnect to server...")
+                break
+
+        # group command
+        print("Selecting active group...")
+        if conn.group(name):
+            print("Group command successful...")
+        else:
+            print("Group command failed...")
+            continue
+
+        # remember the article range of the group
+        group_id = getgroup(session, name)
+        session.query(database.Groups).filter_by(id=group_id).update({'low': conn.group_low, 'high': conn.group_high})
         session.commit()
 
-    else:
-        print("Xzver command failed...")
+        # only fetch what we are missing
+        if args.backfill:
+            backfill(conn, session, group_id, conn.group_low, conn.group_high, range_size, positions)
+            continue
 
-    # quit
-    if conn.quit():
-        print("Quit command successfull...")
-    else:
-        print("Quit command failed...")
\ No newline at end of file
+        # refresh a single header instead of indexing
+        if args.refresh:
+            refresh(conn, session, args.refresh, conn.group_low, conn.group_high, range_size)
+            continue
+
+        # xover command
+        # print("Sending XOver command...")
+        # if conn.over():
+        #     print("XOver command successful...")
+        # else:
+        #     print("XOver command failed...")
+
+        # xzver command
+        # carry on after the newest article we have; older gaps are left to
+        # --backfill
+        last = database.lastcovered(session, group_id)
+        first = conn.group_low if last is None else max(conn.group_low, last + 1)
+        if first > conn.group_high:
+            print("No new articles...")
+            continue
+
+        # spread the ranges over every connection to every server
+        fetcher = None
+        if connections > 1 or servers:
+            pool = [nntp.fetcher.Server(server, port, use_ssl, username, password, connections, connect_timeout=timeout, read_timeout=timeout, rcvbuf=rcvbuf, nodelay=nodelay)]
+            pool.extend(nntp.fetcher.Server(**s) for s in servers)
+
+            fetcher = nntp.fetcher.RangeFetcher(pool, name, cache)
+            ranges = [(low, min(low + range_size - 1, conn.group_high)) for low in range(first, conn.group_high + 1, range_size)]
+            blocks = fetcher.fetch(ranges)
+
+            # our connection counts against the server's limit, so close it
+            # while the fetcher's connections are open
+            conn.quit()
+            conn.s.close()
+            conn.s = None
+        else:
+            blocks = fetchranges(conn, first, conn.group_high, range_size)
+
+        for low, high, lines in decodeblocks(blocks, workers):
+            # drop damaged blocks from the cache so they are fetched again
+            # (by --backfill once later ranges are indexed)
+            if lines is None:
+                print("Failed to decode %d-%d..." % (low, high))
+                if cache is not None:
+                    cache.remove(name, low, high)
+                continue
+
+            ingest(session, group_id, lines, positions)
+            print("Indexed %d-%d..." % (low, high))
+
+        if fetcher is not None:
+            for host, count, failures, size, rate in fetcher.report():
+                print("%s: %d ranges, %d failures, %d bytes, %.0f bytes/second" % (host, count, failures, size, rate))
+            for index in sorted(fetcher.failed):
+                print("Failed to fetch %d-%d from any server..." % fetcher.ranges[index])
+
+    # quit (unless our connection is already closed)
+    if conn.s is not None:
+        if conn.quit():
+            print("Quit command successfull...")
+        else:
+            print("Quit command failed...")
\ No newline at end of file
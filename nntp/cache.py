@@ -0,0 +1,143 @@
+import os
+import re
+import threading
+
+
+class OverviewCache:
+    def __init__(self, path, max_size=None):
+        """Constructor
+
+        Pass in the directory to store cached overview blocks in and the
+        maximum number of bytes the cache may use (None for no limit).
+
+        The cache may be shared between threads. It is only an optimisation,
+        so errors reading or writing it are treated as a miss rather than
+        passed on to the caller.
+        """
+
+        self.path = path
+        self.max_size = max_size
+
+        # held while reading or changing entries
+        self.lock = threading.RLock()
+
+        # pattern for our cache file names
+        self.pattern = re.compile(r"^(\d+)-(\d+)\.yenc$")
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def filename(self, group, low, high):
+        """Cache file name
+
+        Get the path of the cache file for a group and article range.
+        """
+        return os.path.join(self.path, group, "%d-%d.yenc" % (low, high))
+
+    def get(self, group, low, high):
+        """Get a cached block
+
+        Return the raw (still compressed) overview data for a group and
+        article range or None if it is not cached.
+        """
+        filename = self.filename(group, low, high)
+
+        with self.lock:
+            try:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+
+                # mark the entry as recently used
+                os.utime(filename, None)
+            except (IOError, OSError):
+                return None
+
+        return data
+
+    def put(self, group, low, high, data):
+        """Store a block
+
+        Write the raw overview data for a group and article range to the
+        cache, evicting the least recently used entries if we are too big.
+        """
+        filename = self.filename(group, low, high)
+
+        with self.lock:
+            try:
+                directory = os.path.dirname(filename)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+
+                # write to a temporary file first so we never leave a partial entry
+                temp = filename + ".tmp"
+                with open(temp, 'wb') as f:
+                    f.write(data)
+                os.rename(temp, filename)
+
+                self.evict()
+            except (IOError, OSError):
+                pass
+
+    def remove(self, group, low, high):
+        """Remove a block
+
+        Remove the cached overview data for a group and article range, if any.
+        """
+        with self.lock:
+            try:
+                os.remove(self.filename(group, low, high))
+            except OSError:
+                pass
+
+    def ranges(self, group):
+        """Cached ranges
+
+        List the (low, high) article ranges cached for a group in order.
+        """
+        directory = os.path.join(self.path, group)
+        if not os.path.isdir(directory):
+            return []
+
+        results = []
+        for name in os.listdir(directory):
+            match = self.pattern.match(name)
+            if match:
+                results.append((int(match.group(1)), int(match.group(2))))
+
+        results.sort()
+        return results
+
+    def evict(self):
+        """Evict entries
+
+        Remove the least recently used entries until the cache fits within
+        its maximum size.
+        """
+        if self.max_size is None:
+            return
+
+        with self.lock:
+            entries = []
+            total = 0
+
+            for group in os.listdir(self.path):
+                directory = os.path.join(self.path, group)
+                if not os.path.isdir(directory):
+                    continue
+
+                for name in os.listdir(directory):
+                    if not self.pattern.match(name):
+                        continue
+                    filename = os.path.join(directory, name)
+                    stat = os.stat(filename)
+                    entries.append((stat.st_mtime, stat.st_size, filename))
+                    total += stat.st_size
+
+            # oldest first
+            entries.sort()
+
+            for mtime, size, filename in entries:
+                if total <= self.max_size:
+                    break
+                os.remove(filename)
+                total -= size
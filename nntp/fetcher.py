@@ -0,0 +1,276 @@
+import threading
+import time
+
+from nntp import MyNntp
+
+
+class Server:
+    def __init__(self, host, port, use_ssl, username, password, connections=1, weight=1, **options):
+        """Constructor
+
+        Pass in the server details, the number of connections we may open to
+        it and its weight (its expected share of the work relative to the
+        other servers). Any other options are passed on to MyNntp.
+        """
+
+        # just store the values for now
+        self.host = host
+        self.port = port
+        self.ssl = use_ssl
+        self.username = username
+        self.password = password
+        self.connections = connections
+        self.weight = weight
+        self.options = options
+
+        # connections waiting for work and ranges being fetched
+        self.waiting = 0
+        self.inflight = 0
+        self.alive = 0
+
+        # statistics
+        self.ranges = 0
+        self.failures = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def rate(self):
+        """Measured throughput in bytes per second (None until measured).
+
+        """
+        if self.seconds <= 0:
+            return None
+
+        return self.bytes / self.seconds
+
+
+class RangeFetcher:
+    def __init__(self, servers, group, cache=None, window=None):
+        """Constructor
+
+        Pass in a list of Server objects, the group to fetch from and an
+        optional OverviewCache. The window limits how far fetching may run
+        ahead of the consumer (in ranges); it defaults to twice the total
+        number of connections.
+        """
+
+        self.servers = servers
+        self.group = group
+        self.cache = cache
+
+        if window is None:
+            window = 2 * sum(s.connections for s in servers)
+        self.window = window
+
+        self.condition = threading.Condition()
+
+    def connect(self, server):
+        """Open a connection to a server with our group selected.
+
+        Returns None if any step fails.
+        """
+        conn = MyNntp(server.host, server.port, server.ssl, self.cache, **server.options)
+
+        try:
+            if conn.connect() and conn.login(server.username, server.password) and conn.group(self.group):
+                return conn
+        except Exception:
+            pass
+
+        return None
+
+    def speed(self, server):
+        """Relative speed of a server.
+
+        Measured throughput is used once every server has been measured;
+        until then the configured weights are used.
+        """
+        rates = [s.rate() for s in self.servers]
+        if None in rates:
+            return float(server.weight)
+
+        return server.rate()
+
+    def take(self, server):
+        """Wait for a range for a connection to fetch.
+
+        Must be called with the condition held. A range is given to the
+        server with the most spare capacity (speed divided by ranges in
+        flight) among those with a connection waiting, so work is shared
+        according to the weights and then the measured throughput. Returns
+        None once there is nothing left to do.
+        """
+        server.waiting += 1
+
+        try:
+            while True:
+                # nothing left and nothing that could fail and come back
+                if self.stopped or (not self.pending and self.inflight == 0):
+                    return None
+
+                # find the first range this server may fetch
+                index = None
+                for i in self.pending:
+                    if server not in self.excluded.get(i, ()):
+                        index = i
+                        break
+
+                if index is not None and index < self.next + self.window:
+                    # see which server should get it
+                    candidates = [s for s in self.servers if s.waiting and s.alive and s not in self.excluded.get(index, ())]
+                    best = max(candidates, key=lambda s: self.speed(s) / (s.inflight + 1))
+
+                    if best is server:
+                        self.pending.remove(index)
+                        self.inflight += 1
+                        server.inflight += 1
+                        return index
+
+                    # make sure the preferred server sees it
+                    self.condition.notify_all()
+
+                self.condition.wait()
+        finally:
+            server.waiting -= 1
+
+    def release(self, index, server):
+        """Return a range that could not be fetched from a server.
+
+        Must be called with the condition held. The range is retried on
+        another server.
+        """
+        self.excluded.setdefault(index, set()).add(server)
+        server.failures += 1
+
+        if not self.stopped:
+            self.pending.append(index)
+            self.pending.sort()
+            self.prune()
+
+    def prune(self):
+        """Give up on ranges no remaining server can fetch.
+
+        Must be called with the condition held.
+        """
+        for index in list(self.pending):
+            excluded = self.excluded.get(index, ())
+            if not [s for s in self.servers if s.alive and s not in excluded]:
+                self.pending.remove(index)
+                self.failed.add(index)
+
+    def worker(self, server):
+        """Fetch ranges over a single connection.
+
+        """
+        conn = None
+
+        try:
+            while True:
+                with self.condition:
+                    index = self.take(server)
+
+                if index is None:
+                    break
+
+                if conn is None:
+                    conn = self.connect(server)
+
+                data = False
+                if conn is not None:
+                    low, high = self.ranges[index]
+                    start = time.time()
+                    try:
+                        data = conn.zver(low, high)
+                    except Exception:
+                        # the connection is no good now
+                        conn = None
+                    elapsed = time.time() - start
+
+                with self.condition:
+                    self.inflight -= 1
+                    server.inflight -= 1
+
+                    if data is False:
+                        self.release(index, server)
+                    else:
+                        self.results[index] = data
+                        server.ranges += 1
+                        server.bytes += len(data)
+                        server.seconds += elapsed
+
+                    self.condition.notify_all()
+
+                # give up on this connection if we can not connect
+                if conn is None:
+                    break
+        finally:
+            with self.condition:
+                server.alive -= 1
+                self.prune()
+                self.condition.notify_all()
+
+            if conn is not None:
+                try:
+                    conn.quit()
+                except Exception:
+                    pass
+
+    def fetch(self, ranges):
+        """Fetch the compressed overview for a list of (low, high) ranges.
+
+        Ranges are spread over every connection to every server and yielded
+        as (low, high, data) in the order given. Ranges that failed on every
+        server are skipped and left in self.failed.
+        """
+        self.ranges = list(ranges)
+        self.pending = list(range(len(self.ranges)))
+        self.excluded = {}
+        self.results = {}
+        self.failed = set()
+        self.inflight = 0
+        self.next = 0
+        self.stopped = False
+
+        threads = []
+        for server in self.servers:
+            server.alive = server.connections
+            for i in range(server.connections):
+                thread = threading.Thread(target=self.worker, args=(server,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        try:
+            while self.next < len(self.ranges):
+                with self.condition:
+                    while self.next not in self.results and self.next not in self.failed:
+                        # every connection has gone away
+                        if not any(s.alive for s in self.servers):
+                            self.failed.update(i for i in range(self.next, len(self.ranges)) if i not in self.results)
+                            break
+                        self.condition.wait()
+
+                    index = self.next
+                    data = self.results.pop(index, None)
+                    self.next += 1
+                    self.condition.notify_all()
+
+                if data:
+                    low, high = self.ranges[index]
+                    yield low, high, data
+        finally:
+            # stop any remaining work
+            with self.condition:
+                self.stopped = True
+                del self.pending[:]
+                self.condition.notify_all()
+
+        for thread in threads:
+            thread.join()
+
+    def report(self):
+        """Report per server throughput.
+
+        Return a list of (host, ranges, failures, bytes, bytes per second).
+        """
+        return [(s.host, s.ranges, s.failures, s.bytes, s.rate() or 0.0) for s in self.servers]
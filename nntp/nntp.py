@@ -3,22 +3,55 @@ import socket
 import ssl
 
 
+# ssl context shared by every connection; created by getcontext()
+context = None
+
+
+def getcontext():
+    """Get the shared ssl context.
+
+    Sharing one context between connections means certificates are loaded
+    once. TLS sessions are not resumed; the Python 2 ssl module has no way
+    to pass a session to a new connection.
+    """
+    global context
+
+    if context is None:
+        context = ssl.create_default_context()
+
+    return context
+
+
 class MyNntp:
-    def __init__(self, server, port, use_ssl):
+    def __init__(self, server, port, use_ssl, cache=None, connect_timeout=None, read_timeout=None, rcvbuf=None, nodelay=True, context=None):
         """Constructor
 
-        Pass in the server, port, and ssl usage value for connect.
+        Pass in the server, port, and ssl usage value for connect. An optional
+        OverviewCache may be passed to cache compressed overview results.
+
+        Timeouts are in seconds (None to block), rcvbuf sets the socket receive
+        buffer size and nodelay disables Nagle's algorithm. An ssl context may
+        be passed; otherwise the shared context from getcontext() is used.
         """
 
         # just store the values for now
         self.server = server
         self.port = port
         self.ssl = use_ssl
+        self.cache = cache
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.rcvbuf = rcvbuf
+        self.nodelay = nodelay
+        self.context = context
 
         # define variables we will use throughout our object
         self.s = None
         self.data = unicode()
 
+        # size of each read while receiving multi-line data
+        self.recv_size = 65536
+
         self.code = None
         self.text = None
 
@@ -74,6 +107,50 @@ class MyNntp:
 
         return
 
+    def readlines(self):
+        """Read a multi-line data block.
+
+        Yield each line of a multi-line response (without line endings) as it
+        is received from the server. Dot-stuffing is undone before the line is
+        passed on and the terminating line is consumed but not returned.
+
+        Complete lines are sliced out of the buffer by offset so large
+        responses are not copied once per line.
+        """
+
+        # our position within the data buffer
+        pos = 0
+
+        try:
+            while True:
+                # look for the end of the next line
+                index = self.data.find("\r\n", pos)
+
+                # if we do not have a full line receive more data from server
+                if index == -1:
+                    chunk = self.s.recv(self.recv_size)
+                    if not chunk:
+                        raise socket.error("Connection closed during multi-line response")
+                    self.data = self.data[pos:] + chunk
+                    pos = 0
+                    continue
+
+                line = self.data[pos:index]
+                pos = index + 2
+
+                #  check for end of multi line response
+                if line == ".":
+                    return
+
+                # undo dot-stuffing
+                if line.startswith(".."):
+                    line = line[1:]
+
+                yield line
+        finally:
+            # keep anything we have not processed in the buffer
+            self.data = self.data[pos:]
+
     def connect(self):
         """Connect to NNTP server.
 
@@ -81,12 +158,23 @@ class MyNntp:
         the server and parse the response from the server using standard sockets.
         """
 
-        # create a socket object and connect
+        # create a socket object and set our options (the receive buffer must
+        # be set before connecting for the window size to take effect)
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if self.ssl:
-            self.s = ssl.wrap_socket(self.s)
+        if self.rcvbuf:
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.nodelay:
+            self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # connect
+        self.s.settimeout(self.connect_timeout)
         self.s.connect((self.server, self.port))
 
+        if self.ssl:
+            self.s = (self.context or getcontext()).wrap_socket(self.s, server_hostname=self.server)
+
+        self.s.settimeout(self.read_timeout)
+
         # get data from the server
         self.fetch()
 
@@ -111,6 +199,29 @@ class MyNntp:
 
         return
 
+    def sendbuffers(self, buffers):
+        """Send a list of buffers to the server.
+
+        Plain sockets that support it write all of the buffers with a single
+        vectored call so nothing needs to be copied; otherwise the buffers are
+        joined and written with one sendall.
+        """
+
+        if hasattr(self.s, 'sendmsg') and not isinstance(self.s, ssl.SSLSocket):
+            sent = self.s.sendmsg(buffers)
+
+            # write out whatever the kernel did not take
+            for b in buffers:
+                if sent >= len(b):
+                    sent -= len(b)
+                    continue
+                self.s.sendall(memoryview(b)[sent:])
+                sent = 0
+        else:
+            self.s.sendall(''.join(buffers))
+
+        return
+
     def login(self, username, password):
         """Login to server.
 
@@ -260,8 +371,16 @@ class MyNntp:
     def zver(self, low, high):
         """Compressed overview
 
-        Get compressed headers for the selected newsgroup.
+        Get compressed headers for the selected newsgroup. If we have a cache
+        the results are served from (and stored to) it.
         """
+
+        # check our cache first
+        if self.cache is not None:
+            yencData = self.cache.get(self.group_group, low, high)
+            if yencData is not None:
+                return yencData
+
         self.send("XZVER {0}-{1}".format(low, high))
 
         # check for 224 for over response
@@ -294,9 +413,75 @@ class MyNntp:
                 # receive more data from server
                 self.data += self.s.recv(1024)
 
+        # store the results for next time
+        if self.cache is not None:
+            self.cache.put(self.group_group, low, high, yencData)
+
         # all went well, return true
         return yencData
 
+    def hdr(self, field, low=None, high=None, processor=None):
+        """Header
+
+        Get a single header (or overview metadata item such as :bytes) for a
+        range of articles in the selected newsgroup. HDR is tried first and
+        XHDR is used if the server does not support it.
+
+        If a processor is passed it is called with the article number and
+        value of each result as it arrives; otherwise a list of [number,
+        value] results is returned.
+        """
+
+        # build our range
+        if low is None:
+            articles = ""
+        elif high is None:
+            articles = " %d-" % low
+        else:
+            articles = " %d-%d" % (low, high)
+
+        self.send("HDR %s%s" % (field, articles))
+
+        # check for 225 for hdr response, falling back to xhdr
+        if self.code != '225':
+            self.send("XHDR %s%s" % (field, articles))
+
+            # check for 221 for xhdr response
+            if self.code != '221':
+                return False
+
+        # are we processing results?
+        if processor is None:
+            results = []
+
+        for line in self.readlines():
+            number, sep, value = line.partition(" ")
+
+            if processor is None:
+                results.append([int(number), value])
+            else:
+                processor(int(number), value)
+
+        # all went well, return true
+        if processor is None:
+            return results
+        else:
+            return True
+
+    def overviewfmt(self):
+        """Overview format
+
+        List the fields of the overview returned by the server (in order,
+        after the article number).
+        """
+        self.send("LIST OVERVIEW.FMT")
+
+        # check for 215 for list response
+        if self.code != '215':
+            return False
+
+        return list(self.readlines())
+
     def listactive(self, processor=None):
         """List Active
 
@@ -366,17 +551,65 @@ class MyNntp:
         if self.code != '340':
             return False
 
-        self.s.sendall("From: " + fromheader + "\r\n")
-        self.s.sendall("Subject: " + subjectheader + "\r\n")
-        self.s.sendall("Newsgroups: " + newsgroupsheader + "\r\n")
-        self.s.sendall("\r\n")
-        self.s.sendall(article)
+        # build the headers once and write the whole article in one go
+        headers = "From: %s\r\nSubject: %s\r\nNewsgroups: %s\r\n\r\n" % (fromheader, subjectheader, newsgroupsheader)
+        self.sendbuffers([headers, article, ".\r\n"])
 
-        # send our end of transmission character
-        self.send(".")
+        # get the response from the server
+        self.fetch()
 
         # get code 240 if the server accepted our post
         if self.code != '240':
             return False
 
-        return True
\ No newline at end of file
+        return True
+
+    def retrieve(self, command, code, article=None, processor=None):
+        """Retrieve an article (or a portion of one).
+
+        Send an article retrieval command for the passed message-id or article
+        number (or the current article if neither is given) and stream the
+        multi-line response.
+
+        If a processor is passed each line is handed to it as it arrives so
+        large articles never need to be held in memory; otherwise the lines
+        are returned as a list.
+        """
+
+        # send the command to the server
+        if article is None:
+            self.send(command)
+        else:
+            self.send("%s %s" % (command, article))
+
+        # check for the expected response code
+        if self.code != code:
+            return False
+
+        # are we processing results?
+        if processor is None:
+            return list(self.readlines())
+
+        for line in self.readlines():
+            processor(line)
+
+        # all went well, return true
+        return True
+
+    def body(self, article=None, processor=None):
+        """Body
+
+        Retrieve the body of an article.
+        """
+
+        # get code 222 if the body follows
+        return self.retrieve("BODY", '222', article, processor)
+
+    def article(self, article=None, processor=None):
+        """Article
+
+        Retrieve the headers and body of an article.
+        """
+
+        # get code 220 if the article follows
+        return self.retrieve("ARTICLE", '220', article, processor)
@@ -0,0 +1,156 @@
+import re
+
+from dateutil import parser
+from dateutil import tz
+
+
+# field positions within an overview line when the server uses the standard
+# overview format (RFC 3977 section 8.4)
+DEFAULT_POSITIONS = {
+    'number': 0,
+    'subject': 1,
+    'from': 2,
+    'date': 3,
+    'message-id': 4,
+    'references': 5,
+    'bytes': 6,
+    'lines': 7,
+}
+
+
+# the part counter of a multi-part post, e.g. "file.rar" yEnc (03/50)
+part_pattern = re.compile(r"\((\d+)/(\d+)\)")
+
+
+def filepart(subject):
+    """Split a subject into its file, part number and number of parts.
+
+    The file is the subject without its last part counter so every part of
+    a file shares it. Subjects without a counter are a single part.
+    """
+    matches = list(part_pattern.finditer(subject))
+    if not matches:
+        return subject, 1, 1
+
+    match = matches[-1]
+    name = (subject[:match.start()] + subject[match.end():]).strip()
+
+    return name, int(match.group(1)), int(match.group(2))
+
+
+def fieldpositions(fmt):
+    """Map the results of LIST OVERVIEW.FMT to field positions.
+
+    The article number is always the first field and is not listed by the
+    server. Fields we do not know keep their default position.
+    """
+    positions = dict(DEFAULT_POSITIONS)
+
+    for index, name in enumerate(fmt):
+        name = name.lower()
+        if name.endswith(":full"):
+            name = name[:-5]
+        name = name.strip(":")
+
+        if name in positions and name != 'number':
+            positions[name] = index + 1
+
+    return positions
+
+
+class Overview(object):
+    """A single overview line.
+
+    Only the raw line is kept when the object is created. The offsets of the
+    tab separated fields are found as far as needed on first access and each
+    field is only converted when it is asked for, so rows that are skipped
+    (duplicates, filtered) cost little more than the line itself.
+    """
+
+    __slots__ = ('line', 'offsets', 'parsed_date', 'parsed_part', 'positions')
+
+    def __init__(self, line, positions=None):
+        self.line = line
+
+        # start offset of each field we have found so far
+        self.offsets = [0]
+
+        self.parsed_date = None
+        self.parsed_part = None
+
+        # field positions, shared between every row of a block
+        self.positions = positions or DEFAULT_POSITIONS
+
+    def field(self, index):
+        """Get the raw value of a field
+
+        Return the field at the passed position as a string (empty if the line
+        does not have that many fields).
+        """
+        offsets = self.offsets
+        line = self.line
+
+        # find the start of fields until we have the one after ours
+        while len(offsets) <= index + 1:
+            start = offsets[-1]
+            if start > len(line):
+                return ''
+            end = line.find("\t", start)
+            if end == -1:
+                end = len(line)
+            offsets.append(end + 1)
+
+        start = offsets[index]
+        if start > len(line):
+            return ''
+
+        return line[start:offsets[index + 1] - 1]
+
+    @property
+    def number(self):
+        return int(self.field(self.positions['number']))
+
+    @property
+    def subject(self):
+        return self.field(self.positions['subject'])
+
+    @property
+    def author(self):
+        return self.field(self.positions['from'])
+
+    @property
+    def date(self):
+        if self.parsed_date is None:
+            date = parser.parse(self.field(self.positions['date']))
+            # store everything as naive utc so dates can be compared
+            if date.tzinfo is not None:
+                date = date.astimezone(tz.tzutc()).replace(tzinfo=None)
+            self.parsed_date = date
+        return self.parsed_date
+
+    @property
+    def part(self):
+        """The file, part number and number of parts of a post (see filepart).
+
+        """
+        if self.parsed_part is None:
+            self.parsed_part = filepart(self.subject)
+        return self.parsed_part
+
+    @property
+    def message_id(self):
+        return self.field(self.positions['message-id'])
+
+    @property
+    def references(self):
+        return self.field(self.positions['references'])
+
+    @property
+    def bytes(self):
+        value = self.field(self.positions['bytes'])
+        return int(value) if value else 0
+
+    @property
+    def lines(self):
+        value = self.field(self.positions['lines'])
+        return int(value) if value else 0
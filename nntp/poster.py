@@ -0,0 +1,211 @@
+import Queue
+import threading
+import time
+
+from nntp import MyNntp
+
+
+class Poster:
+    def __init__(self, server, port, use_ssl, username, password, connections=4, retries=3):
+        """Constructor
+
+        Pass in the server details used for every connection, the number of
+        connections to post over and how many times a connection may try to
+        reconnect before it gives up.
+        """
+
+        # just store the values for now
+        self.server = server
+        self.port = port
+        self.ssl = use_ssl
+        self.username = username
+        self.password = password
+        self.connections = connections
+        self.retries = retries
+
+        # articles waiting to be posted; bounded so encoded parts are only
+        # produced as fast as we can post them
+        self.queue = Queue.Queue(connections * 2)
+
+        # articles we were unable to post
+        self.failed = []
+
+        # per connection statistics
+        self.stats = []
+
+        # workers still taking articles from the queue
+        self.alive = 0
+
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Open a logged in connection.
+
+        Up to retries attempts are made. Returns None if every one fails.
+        """
+
+        for attempt in range(self.retries):
+            conn = MyNntp(self.server, self.port, self.ssl)
+            try:
+                if conn.connect() and conn.login(self.username, self.password):
+                    return conn
+            except Exception:
+                pass
+
+        return None
+
+    def worker(self, stats):
+        """Post articles from the queue over a single connection.
+
+        A lost connection is reopened and the article retried. If we can not
+        connect the worker stops taking work and puts the article it holds
+        back on the queue for the other connections; it is only recorded as
+        failed once no connections are left.
+        """
+
+        conn = None
+
+        # article to hand back if we give up
+        held = None
+
+        try:
+            while True:
+                item = self.queue.get()
+
+                # check for end of work
+                if item is None:
+                    break
+
+                # post, reconnecting once if the connection was lost
+                posted = False
+                for attempt in range(2):
+                    if conn is None:
+                        conn = self.connect()
+                        if conn is None:
+                            stats['gave_up'] = True
+                            held = item
+                            break
+
+                    start = time.time()
+                    try:
+                        posted = conn.post(*item)
+                    except Exception:
+                        # the connection is no good now
+                        conn = None
+                    stats['seconds'] += time.time() - start
+
+                    # no response at all means the connection was lost
+                    if conn is not None and conn.code is None:
+                        conn = None
+
+                    # the server answered, retrying will not help
+                    if conn is not None:
+                        break
+
+                # stop taking work if we can not connect
+                if stats['gave_up']:
+                    break
+
+                if posted:
+                    stats['articles'] += 1
+                    stats['bytes'] += len(item[3])
+                else:
+                    with self.lock:
+                        self.failed.append(item)
+        finally:
+            with self.lock:
+                self.alive -= 1
+
+            # leave our article to any connection still working
+            if held is not None and not self.put(held):
+                with self.lock:
+                    self.failed.append(held)
+
+            if conn is not None:
+                try:
+                    conn.quit()
+                except Exception:
+                    pass
+
+    def put(self, item):
+        """Queue an item for the workers.
+
+        Returns False (without queueing it) once every worker has stopped.
+        """
+
+        while True:
+            with self.lock:
+                if self.alive == 0:
+                    return False
+
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+
+    def post(self, articles):
+        """Post articles over a pool of connections.
+
+        Articles are (from, subject, newsgroups, body) tuples where body is a
+        ready to send buffer such as those yielded by Encoder.yencodefile. The
+        articles may be a generator; they are consumed as connections become
+        free.
+
+        Returns True if every article was posted.
+        """
+
+        self.failed = []
+        self.stats = []
+        self.alive = self.connections
+        threads = []
+
+        for i in range(self.connections):
+            stats = {'connection': i, 'articles': 0, 'bytes': 0, 'seconds': 0.0, 'gave_up': False}
+            self.stats.append(stats)
+
+            thread = threading.Thread(target=self.worker, args=(stats,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for article in articles:
+                # every connection has gone away
+                if not self.put(article):
+                    with self.lock:
+                        self.failed.append(article)
+        finally:
+            # tell each remaining worker we are done
+            for thread in threads:
+                self.put(None)
+
+            for thread in threads:
+                thread.join()
+
+            # anything left behind by workers that stopped early
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is not None:
+                    self.failed.append(item)
+
+        return len(self.failed) == 0
+
+    def report(self):
+        """Report per connection throughput.
+
+        Return a list of (connection, articles, bytes, bytes per second).
+        """
+
+        results = []
+
+        for stats in self.stats:
+            rate = 0.0
+            if stats['seconds'] > 0:
+                rate = stats['bytes'] / stats['seconds']
+            results.append((stats['connection'], stats['articles'], stats['bytes'], rate))
+
+        return results
@@ -0,0 +1,165 @@
+"""nzb
+
+Write NZB files for posts in the index.
+"""
+
+import calendar
+import hashlib
+import os
+import shutil
+from xml.sax.saxutils import escape, quoteattr
+
+from sqlalchemy import func, select
+import database
+
+
+def encode(value):
+    """Encode a database value for writing to the NZB file.
+
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def filematch(column, pattern):
+    """Build the condition matching file names against a pattern.
+
+    A pattern without wildcards matches a file name exactly and one whose
+    only wildcard is a trailing % matches by prefix; both are range scans
+    of the (h_file, part) index and are case sensitive. Any other pattern
+    is an SQL LIKE pattern and has to scan every row.
+    """
+    if not isinstance(pattern, unicode):
+        pattern = pattern.decode('utf-8')
+
+    prefix = pattern[:-1] if pattern.endswith('%') else None
+
+    # anything but a plain prefix
+    if '_' in pattern or '%' in (pattern if prefix is None else prefix):
+        return column.like(pattern)
+
+    if prefix is None:
+        return column == pattern
+
+    if not prefix:
+        return column != None
+
+    # every name starting with the prefix sorts below the prefix with its last
+    # character incremented
+    return (column >= prefix) & (column < prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+
+
+def filequery(pattern):
+    """Build the query for every part of the files matching a pattern.
+
+    The pattern is matched against the file name (the subject without its
+    part counter, see filematch). Rows come back grouped by file and
+    ordered by part.
+    """
+    articles = database.articlestable()
+    groups = database.Groups.__table__
+
+    return select([articles.c.h_file, articles.c.part, articles.c.h_subject, articles.c.h_from,
+                   articles.c.h_date, articles.c.h_message_id, articles.c.h_bytes, groups.c.name]).select_from(
+        articles.outerjoin(groups, groups.c.id == articles.c.group_id)
+    ).where(filematch(articles.c.h_file, pattern)).order_by(articles.c.h_file, articles.c.part, articles.c.h_date)
+
+
+def writenzb(session, out, pattern):
+    """Write an NZB for the files matching a pattern.
+
+    Rows are streamed from the database and written as they arrive, so the
+    memory used does not depend on the size of the release. Returns the
+    number of files written.
+    """
+    connection = session.connection().execution_options(stream_results=True)
+
+    out.write('<?xml version="1.0" encoding="utf-8"?>\n')
+    out.write('<!DOCTYPE nzb PUBLIC "-//newzBin//DTD NZB 1.1//EN" "http://www.newzbin.com/DTD/nzb/nzb-1.1.dtd">\n')
+    out.write('<nzb xmlns="http://www.newzbin.com/DTD/2003/nzb">\n')
+
+    files = 0
+    current = None
+    last_part = None
+
+    for row in connection.execute(filequery(pattern)):
+        # start of a new file
+        if row.h_file != current:
+            if current is not None:
+                out.write('  </segments>\n </file>\n')
+
+            date = calendar.timegm(row.h_date.timetuple()) if row.h_date else 0
+            out.write(' <file poster=%s date="%d" subject=%s>\n' % (quoteattr(encode(row.h_from or '')), date, quoteattr(encode(row.h_subject))))
+            out.write('  <groups>\n   <group>%s</group>\n  </groups>\n' % escape(encode(row.name or '')))
+            out.write('  <segments>\n')
+
+            current = row.h_file
+            last_part = None
+            files += 1
+
+        # skip reposts of a part we already have
+        if row.part == last_part:
+            continue
+        last_part = row.part
+
+        out.write('   <segment bytes="%d" number="%d">%s</segment>\n' % (row.h_bytes or 0, row.part or 1, escape(encode(row.h_message_id.strip('<>')))))
+
+    if current is not None:
+        out.write('  </segments>\n </file>\n')
+
+    out.write('</nzb>\n')
+
+    return files
+
+
+class NzbCache:
+    def __init__(self, path):
+        """Constructor
+
+        Pass in the directory to keep generated NZB files in.
+        """
+
+        self.path = path
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def fingerprint(self, session, pattern):
+        """Fingerprint the rows an NZB is built from.
+
+        The number of matching rows, their total size and the newest date
+        change whenever a part arrives or expires. Ids are not used as each
+        partition numbers its rows from one.
+        """
+        articles = database.articlestable()
+        query = select([func.count(), func.sum(articles.c.h_bytes), func.max(articles.c.h_date)]).where(filematch(articles.c.h_file, pattern))
+        count, total, newest = session.execute(query).fetchone()
+
+        return "%d:%s:%s" % (count, total, newest)
+
+    def write(self, session, out, pattern):
+        """Write an NZB for a pattern, from the cache if it is still current.
+
+        """
+        key = os.path.join(self.path, hashlib.sha1(encode(pattern)).hexdigest())
+        fingerprint = self.fingerprint(session, pattern)
+
+        # check for a current cached copy
+        try:
+            with open(key + '.fingerprint') as f:
+                cached = f.read()
+        except IOError:
+            cached = None
+
+        if cached != fingerprint or not os.path.exists(key + '.nzb'):
+            # generate a new copy, replacing the old one only once complete
+            with open(key + '.tmp', 'wb') as f:
+                writenzb(session, f, pattern)
+            os.rename(key + '.tmp', key + '.nzb')
+
+            with open(key + '.fingerprint', 'w') as f:
+                f.write(fingerprint)
+
+        with open(key + '.nzb', 'rb') as f:
+            shutil.copyfileobj(f, out)
@@ -0,0 +1,106 @@
+"""yEnc
+
+This is a library for assembling multi-part yEnc messages into a file.
+"""
+
+import mmap
+import os
+from Decoder import Decoder
+from yEncException import yEncException
+
+
+class Assembler:
+
+    def __init__(self, path):
+        # the file we are assembling into
+        self.path = path
+        self.file = None
+        self.map = None
+
+        # decoder for the part currently being received
+        self.decoder = None
+
+        # attributes taken from the yEnc headers
+        self.size = None
+        self.name = None
+        self.total = None
+
+        # completed parts; part number -> (begin, end)
+        self.parts = {}
+
+    def allocate(self, size):
+        """Allocate the output file
+
+        Create (or reuse) the output file at its full size and memory map it
+        so each part can be written straight to its offset. The file is
+        extended with truncate so no data is written until parts arrive.
+        """
+
+        # reuse an existing file so interrupted downloads can be resumed
+        if os.path.exists(self.path):
+            self.file = open(self.path, 'r+b')
+        else:
+            self.file = open(self.path, 'w+b')
+
+        self.file.truncate(size)
+        self.size = size
+
+        # an empty file can not be mapped
+        if size > 0:
+            self.map = mmap.mmap(self.file.fileno(), size)
+
+    def feed(self, line):
+        """Process a single line of an article
+
+        Pass every line of a BODY or ARTICLE response (without line endings)
+        to this function. Lines outside of the yEnc data are ignored.
+        """
+
+        # start a new part on every header
+        if line.startswith('=ybegin '):
+            self.decoder = Decoder()
+
+        # ignore anything until we see a header
+        if self.decoder is None:
+            return
+
+        self.decoder.feed(line)
+
+        # once we know the size of the file, we can set up our output
+        if self.decoder.output is None and self.decoder.size is not None:
+            if self.file is None:
+                self.allocate(self.decoder.size)
+                self.name = self.decoder.name
+                self.total = self.decoder.total
+            elif self.decoder.size != self.size:
+                raise yEncException('Part size does not match the size of previous parts')
+
+            self.decoder.output = self.map
+
+        # check for the end of this part
+        if self.decoder.yenc_footer is not None:
+            part = self.decoder.part or 1
+            self.parts[part] = ((self.decoder.begin or 1), self.decoder.offset)
+            self.decoder = None
+
+    def complete(self):
+        """Check if all parts have been assembled
+
+        """
+        if self.total is None:
+            return len(self.parts) > 0
+
+        return len(self.parts) == self.total
+
+    def close(self):
+        """Flush and close the output file
+
+        """
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
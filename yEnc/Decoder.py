@@ -4,16 +4,17 @@ This is a library for decoding the yEnc standard.
 """
 
 import zlib
-import yEncException
+from yEncException import yEncException
 
 
 class Decoder:
-    def __init__(self, raw):
-        # holds the data to decode
+    def __init__(self, raw=None, output=None):
+        # holds the decoded data
         self.data = None
 
-        # holds header/footer and the encoded data
+        # holds header/footer and the decoded data chunks
         self.yenc_header = None
+        self.yenc_part_header = None
         self.yenc_footer = None
         self.yenc_data = None
 
@@ -28,8 +29,26 @@ class Decoder:
         self.size = None
         self.name = None
 
+        # multi-part yEnc attributes
+        self.part = None
+        self.total = None
+        self.begin = None
+        self.end = None
+        self.pcrc = None
+
+        # when set, decoded data is written here (at the part offset) rather
+        # than being kept in memory; anything supporting seek/write and
+        # slicing (such as an mmap) may be used
+        self.output = output
+        self.offset = 0
+
+        # running crc and byte count of the decoded data
+        self.calc_crc = 0
+        self.calc_size = 0
+
         # was data passed?
-        self.scan(raw)
+        if raw is not None:
+            self.scan(raw)
 
     def ydecode(self, line):
         """Decode one character using the yEnc algorithm.
@@ -74,77 +93,82 @@ class Decoder:
 
         """
 
-        # break the lines apart
-        lines = raw.splitlines()
-
-        # flags for processing
-        header_flag = False
-        part_flag = False
-        data_flag = False
-        footer_flag = False
-
         # process line by line
-        for line in lines:
-            # remove proceeding/trailing whitespace
-            line.strip()
-
-            # check for header
-            if line.startswith('=ybegin '):
-                if self.yenc_header is None:
-                    self.yenc_header = line
-                    self.yenc_data = []
-                    header_flag = True
-                    data_flag = True
-                    self.processheader()
-                else:
-                    raise yEncException('At least two =ybegin lines found')
-                continue
+        for line in raw.splitlines():
+            self.feed(line)
 
-            # check for part
-            if line.startswith('=ypart ') and (header_flag is True):
-                header_flag = False
-                continue
+        # the footer is where size and crc are verified
+        if self.yenc_footer is None:
+            raise yEncException('No =yend line found')
 
-            # check for footer
-            if line.startswith('=yend '):
-                if self.yenc_footer is None:
-                    self.yenc_footer = line
-                    data_flag = False
-                    footer_flag = True
-                    self.processfooter()
-                else:
-                    raise yEncException('At least two =yend lines found')
-                continue
+        # join the decoded data
+        self.data = ''.join(self.yenc_data)
 
-            # remove the header flag if set
-            if header_flag is not False:
-                header_flag = False
+    def feed(self, line):
+        """Process a single line of yEnc data.
 
-            # determine if this is data
-            if data_flag:
-                self.yenc_data.append(line)
+        Lines may be passed one at a time as they are received (without line
+        endings). Anything before the =ybegin line or after the =yend line is
+        ignored so article headers and trailing text can be fed as well.
 
-        # decode to data
-        self.data = ''
-
-        for line in self.yenc_data:
-            self.data += self.ydecode(line)
-
-        # compare the size to decoded data
-        length = len(self.data)
-        # if self.size != length:
-        #     raise yEncException('Size does not match header/footer value')
+        Decoded data is written to the output at the offset declared by the
+        =ypart line if an output was given, otherwise it is kept in memory.
+        """
 
-        # crc the data for compare
-        calc_crc = zlib.crc32(self.data) & 0xffffffff
-        if self.crc != calc_crc:
-            raise yEncException('CRC32 does not match footer value')
+        # check for header
+        if line.startswith('=ybegin '):
+            if self.yenc_header is None:
+                self.yenc_header = line
+                self.yenc_data = []
+                self.processheader()
+            else:
+                raise yEncException('At least two =ybegin lines found')
+            return
+
+        # ignore anything outside of the yEnc data
+        if self.yenc_header is None or self.yenc_footer is not None:
+            return
+
+        # check for part (only valid directly after the header)
+        if line.startswith('=ypart ') and self.multipart and self.yenc_part_header is None:
+            self.yenc_part_header = line
+            self.processpart()
+            return
+
+        # check for footer
+        if line.startswith('=yend '):
+            self.yenc_footer = line
+            self.processfooter()
+            return
+
+        # decode the line and store it
+        decoded = self.ydecode(line)
+
+        if self.output is None:
+            self.yenc_data.append(decoded)
+        else:
+            # make sure we never write outside of our part
+            if self.end is not None and self.offset + len(decoded) > self.end:
+                raise yEncException('Decoded data exceeds the =ypart end offset')
+            self.output.seek(self.offset)
+            self.output.write(decoded)
+
+        self.offset += len(decoded)
+
+        # keep our running crc and size up to date
+        self.calc_crc = zlib.crc32(decoded, self.calc_crc)
+        self.calc_size += len(decoded)
 
     def processheader(self):
         """Process the =ybegin line into its components
 
         """
-        parts = self.yenc_header.split()
+        # the name is always the last value and may contain spaces
+        header, sep, name = self.yenc_header.partition(' name=')
+        if sep:
+            self.name = name.strip()
+
+        parts = header.split()
 
         for part in parts:
             check = part.split('=')
@@ -157,24 +181,87 @@ class Decoder:
                 self.size = int(check[1])
                 continue
 
-            if check[0] == 'name':
-                self.name = check[1]
+            if check[0] == 'part':
+                self.part = int(check[1])
+                self.multipart = True
                 continue
 
+            if check[0] == 'total':
+                self.total = int(check[1])
+                continue
+
+    def processpart(self):
+        """Process the =ypart line into its components
+
+        """
+        parts = self.yenc_part_header.split()
+
+        for part in parts:
+            check = part.split('=')
+
+            if check[0] == 'begin':
+                self.begin = int(check[1])
+                continue
+
+            if check[0] == 'end':
+                self.end = int(check[1])
+                continue
+
+        # make sure the part makes sense
+        if self.begin is None or self.end is None or self.begin < 1 or self.end < self.begin - 1:
+            raise yEncException('Invalid =ypart line')
+        if self.size is not None and self.end > self.size:
+            raise yEncException('Part end offset is beyond the size in the header')
+
+        # offsets in the part header are one based
+        self.offset = self.begin - 1
+
     def processfooter(self):
         """Process the =yend line into its components
 
         """
         parts = self.yenc_footer.split()
 
+        # size of the data in this message (the part for multi-part messages)
+        size = None
+
         for part in parts:
             check = part.split('=')
 
             if check[0] == 'size':
-                if self.size != int(check[1]):
-                    raise yEncException("Size in footer does not match size in header")
+                size = int(check[1])
                 continue
 
             if check[0] == 'crc32':
                 self.crc = int(check[1], 16)
-                continue
\ No newline at end of file
+                continue
+
+            if check[0] == 'pcrc32':
+                self.pcrc = int(check[1], 16)
+                continue
+
+        self.verify(size)
+
+    def verify(self, size):
+        """Verify the decoded data against the header/footer values
+
+        The crc and size are accumulated while decoding so this does not need
+        another pass over the data.
+        """
+        calc_crc = self.calc_crc & 0xffffffff
+
+        if self.multipart:
+            # the footer size is the size of this part
+            if size is not None and size != self.calc_size:
+                raise yEncException('Size in footer does not match decoded part size')
+            if self.begin is not None and self.end - self.begin + 1 != self.calc_size:
+                raise yEncException('Decoded part size does not match =ypart begin/end')
+            if self.pcrc is not None and self.pcrc != calc_crc:
+                raise yEncException('Part CRC32 does not match footer value')
+        else:
+            if size is not None and self.size != size:
+                raise yEncException("Size in footer does not match size in header")
+            if self.size != self.calc_size:
+                raise yEncException('Size does not match header/footer value')
+            if self.crc is not None and self.crc != calc_crc:
+                raise yEncException('CRC32 does not match footer value')
@@ -3,8 +3,13 @@
 This is a library for encoding using the yEnc standard.
 """
 
+import collections
+import mmap
+import multiprocessing
+import os
 import zlib
-import yEncException
+from yEncException import yEncException
+
 
 class Encoder:
 
@@ -115,11 +120,12 @@ class Encoder:
         # loop over data passed
         for char in chunk:
 
-            # check for first character of line
+            # check for first character of line (which may also be the last
+            # character of data)
             if len(line) == 0:
-                character = self.yencode(char, first=True)
-            # check for last character of line
-            elif len(line) == self.line_length:
+                character = self.yencode(char, first=True, last=(len(chunk) == count))
+            # check for last character of line (this character fills it)
+            elif len(line) + 1 >= self.line_length:
                 character = self.yencode(char, last=True)
             # check for last character of data
             elif len(chunk) == count:
@@ -130,6 +136,7 @@ class Encoder:
 
             # store the encoded character(s) on our line
             line += character
+            count += 1
 
             # check if we have a full line
             if len(line) >= self.line_length:
@@ -230,7 +237,7 @@ class Encoder:
             part['yenc_part_header'] = '=ypart begin=' + str(start_offset+1) + ' end=' + str(stop_offset)
 
             # generate the footer
-            part['yenc_footer'] = '=yend size=' + str(part['part_length']) + ' part=' + str(i+1) + ' pcrc=' + "%08x"%(part['part_crc'] & 0xFFFFFFFF) + ' crc32=' + "%08x"%(self.crc)
+            part['yenc_footer'] = '=yend size=' + str(part['part_length']) + ' part=' + str(i+1) + ' pcrc32=' + "%08x"%(part['part_crc'] & 0xFFFFFFFF) + ' crc32=' + "%08x"%(self.crc)
 
             # append yEnc data
             part['yenc_data'].append(self.yencodedata(part['part_data']))
@@ -238,6 +245,84 @@ class Encoder:
             # store to our yenc_data
             self.yenc_data.append(part)
 
+    def yencodepart(self, data, part, total, begin, size, crc):
+        """Encode one part of a multi-part yEnc message into a single buffer.
+
+        The header, part header, encoded lines and footer are joined with CRLF
+        line endings so the result can be written to a socket as the body of
+        an article without any further processing.
+        """
+
+        end = begin + len(data) - 1
+
+        # crc of this parts data before encoding
+        part_crc = zlib.crc32(data) & 0xffffffff
+
+        lines = ['=ybegin part=' + str(part) + ' total=' + str(total) + ' line=' + str(self.line_length) + ' size=' + str(size) + ' name=' + self.name,
+                 '=ypart begin=' + str(begin) + ' end=' + str(end)]
+        lines.extend(self.yencodedata(data))
+        lines.append('=yend size=' + str(len(data)) + ' part=' + str(part) + ' pcrc32=' + "%08x"%(part_crc) + ' crc32=' + "%08x"%(crc))
+        lines.append('')
+
+        return '\r\n'.join(lines)
+
+    def yencodefile(self, path, filename=None, processes=None):
+        """Encode a file into a multi-part yEnc message part by part.
+
+        The file is memory mapped rather than read into memory and each part
+        is yielded as a (part number, buffer) tuple once it has been encoded,
+        so only a handful of parts are ever held in memory at once.
+
+        If processes is greater than one the parts are encoded concurrently
+        in a process pool; parts are still yielded in order.
+        """
+
+        self.multipart = True
+
+        # set the name of the file
+        if filename is not None:
+            self.name = filename
+        if self.name is None:
+            self.name = os.path.basename(path)
+
+        self.size = os.path.getsize(path)
+
+        # the footer of every part needs the crc of the whole file
+        self.crc = filecrc(path)
+
+        # determine number of parts
+        parts_total = self.size / self.part_size
+        if (self.size % self.part_size) != 0:
+            parts_total += 1
+
+        # arguments for encoding each part
+        jobs = ((path, self.name, self.line_length, i+1, parts_total, i * self.part_size, self.part_size, self.size, self.crc)
+                for i in range(parts_total))
+
+        # encode in this process
+        if processes is None or processes <= 1:
+            for job in jobs:
+                yield job[3], encodepart(job)
+            return
+
+        # encode in a pool, keeping a bounded number of parts in flight
+        pool = multiprocessing.Pool(processes)
+        pending = collections.deque()
+
+        try:
+            for job in jobs:
+                pending.append((job[3], pool.apply_async(encodepart, (job,))))
+
+                if len(pending) >= processes * 2:
+                    part, result = pending.popleft()
+                    yield part, result.get()
+
+            while pending:
+                part, result = pending.popleft()
+                yield part, result.get()
+        finally:
+            pool.terminate()
+
     def checkparams(self):
         """Check the object parameters
 
@@ -267,4 +352,41 @@ class Encoder:
 
         # set the name of the file
         if filename is not None:
-            self.name = filename
\ No newline at end of file
+            self.name = filename
+
+
+def filecrc(path, chunk_size=1048576):
+    """Calculate the crc32 of a file without reading it all into memory.
+
+    """
+    crc = 0
+
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+
+    return crc & 0xffffffff
+
+
+def encodepart(job):
+    """Encode a single part of a file.
+
+    This is a module level function so it can be handed to a process pool.
+    The part is sliced from a memory map of the file so workers only ever
+    read the data they encode.
+    """
+    path, name, line_length, part, total, offset, part_size, size, crc = job
+
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = m[offset:offset + part_size]
+        finally:
+            m.close()
+
+    encoder = Encoder(filename=name, line_length=line_length, part_size=part_size)
+
+    return encoder.yencodepart(data, part, total, offset + 1, size, crc)